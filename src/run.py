@@ -10,8 +10,9 @@ import json
 import base64
 import www_authenticate
 # import semver
-from collections import defaultdict
-from functools import cmp_to_key
+from dataclasses import dataclass, field
+from operator import attrgetter
+from functools import lru_cache
 from time import sleep
 from pathlib import Path
 from case_insensitive_dict import CaseInsensitiveDict
@@ -41,6 +42,11 @@ if not args.login and not args.dest:
     print('--dest is required')
     exit(-1)
 
+# loop-invariant forms of the tag prefix/suffix, hoisted once for the
+# hot paths that would otherwise re-evaluate (args.x or '') per tag
+PREFIX = args.prefix or ''
+SUFFIX = args.suffix or ''
+
 
 docker_config_auth_file = str(Path('~/.docker/config.json').expanduser())
 
@@ -181,40 +187,153 @@ def parse_image_url(url):
     return result
 
 
-def parse_version(text):
-    if args.prefix:
-        if not text.startswith(args.prefix):
+# sentinels for the comparison key: a missing minor/patch/rc part sorts later
+# than any numbered one (a plain '13' is newer than every '13.x'), a missing
+# ce part sorts earlier
+MISSING_PART = 10**9
+
+
+@dataclass(frozen=True, slots=True)
+class Version:
+    major: str
+    minor: str = None
+    patch: str = None
+    rc: str = None
+    ce: str = None
+    rest: str = None
+    # the original tag text; equal to str_version(self) for parsed tags
+    raw: str = field(default=None, compare=False)
+    _sort_key: tuple = field(init=False, repr=False, compare=False)
+    _group_key_major: str = field(init=False, repr=False, compare=False)
+    _group_key_minor: str = field(init=False, repr=False, compare=False)
+    _str: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # str_version(self) reproduces the parsed input exactly, so the
+        # raw tag doubles as the cached string form
+        object.__setattr__(self, '_str', self.raw)
+        # rest suffixes like '-alpine' repeat across many tags; interning
+        # shares one string and lets comparisons shortcut on identity
+        if self.rest:
+            object.__setattr__(self, 'rest', sys.intern(self.rest))
+        object.__setattr__(self, '_sort_key', (
+            int(self.major),
+            int(self.minor) if self.minor else MISSING_PART,
+            int(self.patch) if self.patch else MISSING_PART,
+            int(self.rc) if self.rc else MISSING_PART,
+            int(self.ce) if self.ce else -1,
+            self.rest or '',
+        ))
+        # the grouping keys this tag contributes to, built once at parse
+        # time instead of being concatenated again in every grouping loop
+        # interned group keys let the grouping dict share one string per
+        # group and compare hashes by identity
+        group_suffix = ('-ce' if self.ce else '') + (self.rest or '') + SUFFIX
+        object.__setattr__(self, '_group_key_major', sys.intern(PREFIX + self.major + group_suffix))
+        object.__setattr__(self, '_group_key_minor', sys.intern(PREFIX + self.major + '.' + self.minor + group_suffix) if self.minor else None)
+
+
+VERSION_PATTERN = r'^(?P<major>0|[1-9]\d*)(?:\.(?P<minor>0|[1-9]\d*)(?:\.(?P<patch>0|[1-9]\d*))?)?(-((rc(?P<rc>0|[1-9]\d*)\.)?ce\.(?P<ce>0|[1-9]\d*)|rc(?P<rc2>0|[1-9]\d*)))?(?P<rest>-.*)?$'
+VERSION_RE = re.compile(VERSION_PATTERN)
+VERSION_LINE_RE = re.compile(VERSION_PATTERN, re.MULTILINE)
+
+
+def version_from_match(m, raw=None):
+    major, minor, patch, rc, ce, rc2, rest = m.group('major', 'minor', 'patch', 'rc', 'ce', 'rc2', 'rest')
+    return Version(major, minor, patch, rc2 or rc, ce, rest, raw)
+
+
+def strip_prefix_suffix(text, prefix, suffix):
+    if prefix:
+        if not text.startswith(prefix):
             return None
-        text = text[len(args.prefix):]
+        text = text[len(prefix):]
 
-    if args.suffix:
-        if not text.endswith(args.suffix):
+    if suffix:
+        if not text.endswith(suffix):
             return None
-        text = text[:len(text) - len(args.suffix)]
+        text = text[:len(text) - len(suffix)]
+
+    return text
+
+
+@lru_cache(maxsize=4096)
+def parse_version_cached(text, prefix, suffix):
+    stripped = strip_prefix_suffix(text, prefix, suffix)
+    if stripped is None:
+        return None
+
+    # fast path for plain numeric tags like '14.10.2' (most docker tags):
+    # a split+isdigit check with the same leading-zero rule as the regex
+    if '-' not in stripped:
+        parts = stripped.split('.')
+        if 1 <= len(parts) <= 3 and all(p.isascii() and p.isdigit() and (p == '0' or p[0] != '0') for p in parts):
+            parts += [None] * (3 - len(parts))
+            return Version(parts[0], parts[1], parts[2], raw=text)
 
-    m = re.search(r'^(?P<major>0|[1-9]\d*)(?:\.(?P<minor>0|[1-9]\d*)(?:\.(?P<patch>0|[1-9]\d*))?)?(-((rc(?P<rc>0|[1-9]\d*)\.)?ce\.(?P<ce>0|[1-9]\d*)|rc(?P<rc2>0|[1-9]\d*)))?(?P<rest>-.*)?$', text)
+    m = VERSION_RE.search(stripped)
     if not m:
         return None
-    result = m.groupdict()
-    if result['rc2']:
-        result['rc'] = result['rc2']
-    del result['rc2']
-    return result
+    return version_from_match(m, text)
+
+
+def parse_version(text, prefix=None, suffix=None):
+    # Version instances are frozen, so sharing cached ones is safe;
+    # prefix/suffix default to the command line arguments
+    if prefix is None:
+        prefix = args.prefix
+    if suffix is None:
+        suffix = args.suffix
+    return parse_version_cached(text, prefix, suffix)
+
+
+def parse_versions_batch(tags):
+    # join all tags into one buffer and let the regex engine walk it in a
+    # single pass instead of re-entering the interpreter per tag
+    prefix = args.prefix
+    suffix = args.suffix
+    lines = []
+    for text in tags:
+        text = strip_prefix_suffix(text, prefix, suffix)
+        # an empty line never matches (major is required), so it marks
+        # tags that do not carry the configured prefix/suffix
+        lines.append(text if text is not None else '')
+
+    starts = []
+    pos = 0
+    for line in lines:
+        starts.append(pos)
+        pos += len(line) + 1
+
+    results = [None] * len(tags)
+    i = 0
+    for m in VERSION_LINE_RE.finditer('\n'.join(lines)):
+        while starts[i] != m.start():
+            i += 1
+        results[i] = version_from_match(m, tags[i])
+        i += 1
+    return results
 
 
 def str_version(v):
-    return (args.prefix or '') + \
-        v['major'] + \
-        ('.' + v['minor'] if v['minor'] else '') + \
-        ('.' + v['patch'] if v['patch'] else '') + \
-        ('-rc' + v['rc'] + '.ce.' + v['ce'] if 'rc' in v and v['rc'] and 'ce' in v and v['ce'] else '') + \
-        ('-rc' + v['rc'] if 'rc' in v and v['rc'] and ('ce' not in v or not v['ce']) else '') + \
-        ('-ce.' + v['ce'] if ('rc' not in v or not v['rc']) and 'ce' in v and v['ce'] else '') + \
-        ('rest' in v and v['rest'] or '') + \
-        (args.suffix or '')
+    if v._str is None:
+        object.__setattr__(v, '_str', PREFIX +
+            v.major +
+            ('.' + v.minor if v.minor else '') +
+            ('.' + v.patch if v.patch else '') +
+            ('-rc' + v.rc + '.ce.' + v.ce if v.rc and v.ce else '') +
+            ('-rc' + v.rc if v.rc and not v.ce else '') +
+            ('-ce.' + v.ce if not v.rc and v.ce else '') +
+            (v.rest or '') +
+            SUFFIX)
+    return v._str
 
 
 def compare_version(v1, v2):
+    # the parse cache hands out shared instances, so comparing a tag with
+    # itself is a pure identity check
+    if v1 is v2:
+        return 0
     if not v1 and not v2:
         return 0
     if not v1:
@@ -222,69 +341,17 @@ def compare_version(v1, v2):
     if not v2:
         return 1
 
-    if ('rest' in v1 and 'rest' in v2 and not v1['rest'] == v2['rest']) \
-        or ('ce' in v1 and not 'ce' in v2 and v1['ce']) \
-        or (not 'ce' in v1 and 'ce' in v2 and v2['ce']) \
-        or ('ce' in v1 and 'ce' in v2 and v1['ce'] and not v2['ce']) \
-        or ('ce' in v1 and 'ce' in v2 and not v1['ce'] and v2['ce']):
-        raise Exception('Cannot compare versions ' + str_version(v1) + ' and ' + str_version(v2))
-
-    if int(v1['major']) < int(v2['major']):
-        return -1
-    elif int(v1['major']) > int(v2['major']):
-        return 1
-
-    if v1['minor'] and v2['minor']:
-        if int(v1['minor']) < int(v2['minor']):
-            return -1
-        elif int(v1['minor']) > int(v2['minor']):
-            return 1
-    elif v1['minor'] and not v2['minor']:
-        return -1
-    elif not v1['minor'] and v2['minor']:
-        return 1
-
-    if v1['patch'] and v2['patch']:
-        if int(v1['patch']) < int(v2['patch']):
-            return -1
-        elif int(v1['patch']) > int(v2['patch']):
-            return 1
-    elif v1['patch'] and not v2['patch']:
-        return -1
-    elif not v1['patch'] and v2['patch']:
-        return 1
-
-    if v1['rc'] and v2['rc']:
-        if int(v1['rc']) < int(v2['rc']):
-            return -1
-        elif int(v1['rc']) > int(v2['rc']):
-            return 1
-    elif v1['rc'] and not v2['rc']:
-        return -1
-    elif not v1['rc'] and v2['rc']:
-        return 1
+    # the keys are precomputed integer tuples, so this is a single C-level
+    # tuple comparison instead of a field-by-field Python loop
+    return (v1._sort_key > v2._sort_key) - (v1._sort_key < v2._sort_key)
 
-    if 'ce' in v1 and 'ce' in v2 and v1['ce'] and v2['ce']:
-        if int(v1['ce']) < int(v2['ce']):
-            return -1
-        elif int(v1['ce']) > int(v2['ce']):
-            return 1
 
-    # versions are equal
-    return 0
+# C-level attribute fetch for sort/max key functions
+SORT_KEY = attrgetter('_sort_key')
 
 
 def max_version(versions):
-    latest = None
-    for v in versions:
-        if not latest:
-            latest = v
-            continue
-
-        if compare_version(v, latest) > 0:
-            latest = v
-
-    return latest
+    return max((v for v in versions if v), key=SORT_KEY, default=None)
 
 
 token_cache = {}
@@ -387,17 +454,33 @@ src_api = src_host
 print('>>> Read source tags for', src_image)
 src_tags = request_docker_registry(src_api, src_name, 'tags/list')['tags']
 # src_tags = ['14.10.2', '14.10.3', '14.10', '14.11.1-rc', '13.14.0', '13', '13-rc1-alpine', '13-rc2-alpine']
-src_tags = [t for t in src_tags if parse_version(t)]
+src_tags = [(t, v) for t, v in zip(src_tags, parse_versions_batch(src_tags)) if v]
 if args.filter:
-    src_tags = [t for t in src_tags if re.search(args.filter, t)]
-src_tags = [parse_version(t) for t in src_tags]
-src_tags_grouped = defaultdict(list)
+    filter_search = re.compile(args.filter).search
+    src_tags = [(t, v) for t, v in src_tags if filter_search(t)]
+src_tags = [v for t, v in src_tags]
+# keep only the best version seen so far per group key; the groups were
+# only ever reduced with max_version, so the member lists are not needed.
+# each group key is itself a valid tag; record its parsed projection the
+# first time the key appears so it never has to be re-parsed from the
+# string form ('-ce' markers and rest parts of a key parse as rest)
+src_tags_best = {}
+src_tags_latest_parsed = {}
 for t in src_tags:
-    src_tags_grouped[(args.prefix or '') + t['major'] + ('-ce' if t['ce'] else '') + (t['rest'] or '') + (args.suffix or '')].append(t)
-for t in src_tags:
-    if t['minor']:
-        src_tags_grouped[(args.prefix or '') + t['major'] + '.' + t['minor'] + ('-ce' if t['ce'] else '') + (t['rest'] or '') + (args.suffix or '')].append(t)
-src_tags_latest = dict((k, str_version(max_version(src_tags_grouped[k]))) for k in src_tags_grouped.keys())
+    prev = src_tags_best.get(t._group_key_major)
+    if prev is None:
+        src_tags_best[t._group_key_major] = t
+        src_tags_latest_parsed[t._group_key_major] = Version(t.major, rest=('-ce' if t.ce else '') + (t.rest or '') or None, raw=t._group_key_major)
+    elif t._sort_key > prev._sort_key:
+        src_tags_best[t._group_key_major] = t
+    if t.minor:
+        prev = src_tags_best.get(t._group_key_minor)
+        if prev is None:
+            src_tags_best[t._group_key_minor] = t
+            src_tags_latest_parsed[t._group_key_minor] = Version(t.major, t.minor, rest=('-ce' if t.ce else '') + (t.rest or '') or None, raw=t._group_key_minor)
+        elif t._sort_key > prev._sort_key:
+            src_tags_best[t._group_key_minor] = t
+src_tags_latest = dict((k, str_version(v)) for k, v in src_tags_best.items())
 
 dest_image = to_full_image_url(args.dest)
 dest_url = parse_image_url(args.dest)
@@ -409,7 +492,8 @@ dest_api = dest_host
 print('>>> Read destination tags for', dest_image)
 dest_tags = request_docker_registry(dest_api, dest_name, 'tags/list')['tags']
 # dest_tags = ['14.10.2', '14.10.3', '14.10', '14.11.1', '13.14.0', '13']
-dest_tags = [t for t in dest_tags if parse_version(t)]
+# kept as a set: only ever used for membership checks
+dest_tags = {t for t, v in zip(dest_tags, parse_versions_batch(dest_tags)) if v}
 
 
 def mirror_image_tag(tag, dest_tag=None):
@@ -490,25 +574,15 @@ def mirror_image_tag(tag, dest_tag=None):
         execWithRetry('skopeo copy --authfile ' + docker_config_auth_file + ' --all ' + src_image_tag + ' ' + dest_image_tag)
 
 
-def copy_with_exclude(o, exclude):
-    return {
-        k: o[k] for k in o.keys() if k not in exclude
-    }
-
-
-def prepare_for_sort(v):
-    v = copy_with_exclude(v, ['rest'])
-    if 'ce' in v and not v['ce']:
-        v['ce'] = '-1'
-    return v
-
-
 src_tags_sorted = [t for t in src_tags]
-src_tags_sorted.sort(key=cmp_to_key(lambda x, y: compare_version(prepare_for_sort(x), prepare_for_sort(y))))
+src_tags_sorted.sort(key=SORT_KEY)
+# src_tags_latest_parsed was filled during grouping, so the calculated
+# tags sort and the 'latest' calculation reuse those projections without
+# ever re-parsing the key strings
 src_tags_latest_sorted = [t for t in src_tags_latest.keys()]
-src_tags_latest_sorted.sort(key=cmp_to_key(lambda x, y: compare_version(None if x is None else prepare_for_sort(parse_version(x)), None if y is None else prepare_for_sort(parse_version(y)))))
+src_tags_latest_sorted.sort(key=lambda k: src_tags_latest_parsed[k]._sort_key)
 if args.update_latest:
-    src_tag_latest = str_version(max_version([parse_version(t) for t in src_tags_latest_sorted if t is not None]))
+    src_tag_latest = str_version(max_version(src_tags_latest_parsed.values()))
 
 print('New calculated tags are:')
 for dest_tag in src_tags_latest_sorted:
@@ -517,13 +591,14 @@ if args.update_latest:
     print('- latest \t-> ' + src_tags_latest[src_tag_latest])
 
 if not args.no_copy:
+    only_new_tags = args.only_new_tags
     # mirror all existing tags
-    for src_tag in [str_version(t) for t in src_tags_sorted]:
-        if not args.only_new_tags or not src_tag in dest_tags:
+    for src_tag in [t.raw for t in src_tags_sorted]:
+        if not only_new_tags or not src_tag in dest_tags:
             mirror_image_tag(src_tag)
 
     for dest_tag in src_tags_latest_sorted:
-        if not args.only_new_tags or not dest_tag in dest_tags:
+        if not only_new_tags or not dest_tag in dest_tags:
             mirror_image_tag(src_tags_latest[dest_tag], dest_tag)
     if args.update_latest:
         mirror_image_tag(src_tags_latest[src_tag_latest], 'latest')